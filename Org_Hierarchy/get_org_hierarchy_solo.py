@@ -2,7 +2,7 @@
 Script for retrieving and building the complete organizational hierarchy from Microsoft Graph API.
 
 This script is responsible for:
-1. Fetching all enabled users from Microsoft Graph API
+1. Fetching all enabled users from Microsoft Graph API (or only the reporting tree below the starting email)
 2. Building the complete organizational hierarchy tree
 3. Identifying and filtering out service accounts and non-standard users
 4. Determining the root of the organization (typically CEO/highest level executive) if no starting email is provided
@@ -14,27 +14,28 @@ to determine the membership of distribution lists.
 Dependencies:
 - Microsoft Graph API access (tenant ID, client ID, and secret in .env)
 - Required Python modules (will be installed if missing): msal, requests, python-dotenv
+- Optional: orjson for faster JSON parsing and serialization
 """
 
 import os
 import sys
 import json
+import re
 import logging
 import subprocess
+import importlib.util
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from collections import defaultdict
+from collections import Counter
 
 def check_and_install_modules():
     """Check for required modules and install them if missing."""
-    required_modules = ['msal', 'requests', 'python-dotenv']
-    missing_modules = []
-    
-    for module in required_modules:
-        try:
-            __import__(module.replace('-', '_'))
-        except ImportError:
-            missing_modules.append(module)
+    # (pip package name, import name)
+    required_modules = [('msal', 'msal'), ('requests', 'requests'), ('python-dotenv', 'dotenv')]
+    # find_spec locates each module without executing it
+    missing_modules = [package for package, module in required_modules if importlib.util.find_spec(module) is None]
     
     if missing_modules:
         print(f"Installing missing modules: {', '.join(missing_modules)}")
@@ -50,9 +51,16 @@ check_and_install_modules()
 
 # Now import the modules that might have been installed
 import requests
+from requests.adapters import HTTPAdapter
 import msal
 from dotenv import load_dotenv
 
+# orjson is optional - it decodes Graph pages and encodes the output much faster than the stdlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Get the directory where the script is located
 SCRIPT_DIR = Path(__file__).parent.absolute()
 
@@ -62,7 +70,7 @@ logging.basicConfig(
     format='%(asctime)s | %(levelname)-8s | %(name)s | %(funcName)s:%(lineno)d | %(message)s',
     handlers=[
         logging.StreamHandler(),
-        logging.FileHandler(SCRIPT_DIR / 'get_org_hierarchy.log')
+        logging.FileHandler(SCRIPT_DIR / 'get_org_hierarchy.log', delay=True)  # Only created once something is logged
     ]
 )
 logger = logging.getLogger(__name__)
@@ -78,120 +86,525 @@ CLIENT_SECRET = os.environ.get('CLIENT_SECRET')
 if not all([CLIENT_ID, TENANT_ID, CLIENT_SECRET]):
     raise ValueError("Missing required environment variables. Please check your .env file.")
 
+# UPN substrings that identify service, admin and external accounts
+EXCLUDED_UPN_PATTERNS = [
+    "#EXT#",
+    "@avetta1.onmicrosoft.com",
+    "admin@",
+    "noreply",
+    "accounts@",
+    "adm.",
+    "abuse@"
+]
+# Compiled once so each user is checked with a single case-insensitive scan
+EXCLUDED_UPN_RE = re.compile('|'.join(map(re.escape, EXCLUDED_UPN_PATTERNS)), re.IGNORECASE)
+ADMIN_DISPLAY_NAME_RE = re.compile(r'adm', re.IGNORECASE)
+
+# Matches the top-level "@odata.nextLink" member of a raw Graph page. A quote inside a JSON
+# string is always escaped, so this cannot match text inside user fields
+NEXT_LINK_RE = re.compile(rb'[{,]\s*"@odata\.nextLink"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+GRAPH_BATCH_LIMIT = 20  # Maximum number of sub-requests Graph accepts per $batch call
+
+TOKEN_CACHE_FILE = SCRIPT_DIR / '.msal_cache.bin'
+TOKEN_MIN_LIFETIME = 30 * 60  # Seconds a token must have left to be used for a new run
+
+def _load_token_cache():
+    """Loads the MSAL token cache persisted by a previous run, if there is one."""
+    cache = msal.SerializableTokenCache()
+    if TOKEN_CACHE_FILE.exists():
+        try:
+            cache.deserialize(TOKEN_CACHE_FILE.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable token cache %s: %s", TOKEN_CACHE_FILE, e)
+    return cache
+
+def _save_token_cache(cache):
+    """
+    Persists the MSAL token cache, readable only by the current user on POSIX systems.
+
+    On Windows the mode only toggles the read-only flag, so the file inherits the script
+    directory's access rules.
+    """
+    if not cache.has_state_changed:
+        return
+    try:
+        fd = os.open(TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(cache.serialize())
+        os.chmod(TOKEN_CACHE_FILE, 0o600)  # os.open only applies the mode to new files
+    except OSError as e:
+        logger.warning("Could not save token cache %s: %s", TOKEN_CACHE_FILE, e)
+
+def _acquire_token(cache):
+    """Acquires a Graph token through MSAL, serving it from the given cache when possible."""
+    app = msal.ConfidentialClientApplication(
+        CLIENT_ID,
+        authority=f"https://login.microsoftonline.com/{TENANT_ID}",
+        client_credential=CLIENT_SECRET,
+        token_cache=cache
+    )
+    
+    result = app.acquire_token_silent(["https://graph.microsoft.com/.default"], account=None)
+    if not result:
+        result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
+    return result
+
 def get_graph_token():
-    """Get Microsoft Graph API access token."""
+    """Get Microsoft Graph API access token, reusing a cached token from a previous run while it is valid."""
     try:
-        app = msal.ConfidentialClientApplication(
-            CLIENT_ID,
-            authority=f"https://login.microsoftonline.com/{TENANT_ID}",
-            client_credential=CLIENT_SECRET
-        )
-        
-        result = app.acquire_token_silent(["https://graph.microsoft.com/.default"], account=None)
-        if not result:
-            result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
+        cache = _load_token_cache()
+        result = _acquire_token(cache)
+
+        # The run never refreshes its token, so a cached one must outlive a long pagination
+        if "access_token" in result and int(result.get("expires_in", 0)) < TOKEN_MIN_LIFETIME:
+            logger.info("Cached token expires in %s seconds. Acquiring a new one.", result.get("expires_in", 0))
+            cache = msal.SerializableTokenCache()
+            result = _acquire_token(cache)
         
         if "access_token" in result:
+            _save_token_cache(cache)
             return result["access_token"]
         else:
-            logger.error(f"Error getting token: {result.get('error_description', 'Unknown error')}")
+            logger.error("Error getting token: %s", result.get('error_description', 'Unknown error'))
             return None
     except Exception as e:
-        logger.error(f"Exception in get_graph_token: {str(e)}")
+        logger.error("Exception in get_graph_token: %s", e)
         return None
 
-def get_all_org_users(headers):
-    """Fetches all relevant users and their manager IDs efficiently using pagination."""
+def create_graph_session(access_token):
+    """Creates a Session that reuses pooled connections to Graph and sends the token on every call."""
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    })
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+    return session
+
+def _loads(content):
+    """Decode a JSON payload, using orjson when it is available."""
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than the stdlib (e.g. it rejects lone UTF-16 surrogate escapes,
+            # which Graph strings can contain), so let json decide before treating it as invalid
+            pass
+    return json.loads(content)
+
+def _dumps(obj, default=None):
+    """
+    Encode obj as indented UTF-8 JSON bytes, using orjson when it is available.
+
+    orjson always writes non-ASCII characters as raw UTF-8, so the json fallback does the
+    same (ensure_ascii=False) and the file has one encoding whichever encoder ran.
+    Strings holding lone UTF-16 surrogates, which have no UTF-8 form, are written with
+    \\uXXXX escapes instead.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=default, option=orjson.OPT_INDENT_2)
+        except orjson.JSONEncodeError as e:
+            # orjson refuses documents nested more than 255 levels deep, and lone UTF-16 surrogates
+            logger.warning("orjson could not encode the hierarchy (%s). Falling back to the json module.", e)
+    try:
+        return json.dumps(obj, indent=2, default=default, ensure_ascii=False).encode('utf-8')
+    except UnicodeEncodeError:
+        # A lone surrogate has no UTF-8 form; \uXXXX escapes keep it (the output is then ASCII, still valid UTF-8)
+        return json.dumps(obj, indent=2, default=default).encode('ascii')
+
+def get_all_org_users(session, advanced_query=False):
+    """
+    Fetches all relevant users and their manager IDs efficiently using pagination.
+
+    Set advanced_query if the filter is changed to use operators that need Graph's
+    advanced query support.
+    """
     all_users = []
     
     # Simpler filter for API call - more filtering will happen locally
     filter_query = "accountEnabled eq true and userType eq 'Member'"
     
+    # Only the fields written to the output are selected, and $top=999 is the largest page Graph
+    # serves for users. requests already asks for gzip, and every page is kept in memory anyway,
+    # so each page is decoded in one call rather than streamed
     select_query = "id,displayName,userPrincipalName,mail,jobTitle,department"
     expand_query = "manager($select=id)"
     
     # Use Beta endpoint (or v1.0 might work with this simpler filter)
     users_url = f"https://graph.microsoft.com/beta/users?$filter={filter_query}&$select={select_query}&$expand={expand_query}&$top=999"
     
-    # ConsistencyLevel and Count might not be needed for this simpler filter, but keeping them doesn't hurt
-    headers['ConsistencyLevel'] = 'eventual' 
-    users_url += '&$count=true'
+    # ConsistencyLevel: eventual and $count=true are only required for Graph's advanced query
+    # capabilities (endsWith, NOT, $search, ...). This filter uses plain eq comparisons, so by
+    # default the request stays on the regular, strongly consistent path
+    # See https://learn.microsoft.com/graph/aad-advanced-queries
+    headers = {}
+    if advanced_query:
+        headers['ConsistencyLevel'] = 'eventual'
+        users_url += '&$count=true'
 
+    def add_page(data):
+        current_page_users = data.get("value", [])
+        all_users.extend(current_page_users)
+        logger.info("Fetched %s users on this page. Total fetched: %s", len(current_page_users), len(all_users))
+
+    # Graph only exposes the next page through the opaque @odata.nextLink of the current one,
+    # so pages cannot be requested concurrently. Instead the link is read straight from the raw
+    # bytes, and each page is decoded on a worker thread while the next one downloads
     page_num = 1
-    while users_url:
+    decoding = None
+    with ThreadPoolExecutor(max_workers=1) as decode_pool:
+        while users_url:
+            response = None
+            try:
+                logger.info("Fetching page %s of users...", page_num)
+                response = session.get(users_url, headers=headers)
+                response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
+                content = response.content
+                previous, decoding = decoding, decode_pool.submit(_loads, content)
+
+                # Get the next page link
+                next_link = NEXT_LINK_RE.search(content)
+                if next_link:
+                    users_url = json.loads(b'"' + next_link.group(1) + b'"')
+                else:
+                    # Not in the usual place (or the last page) - wait for the decoded page to be sure
+                    users_url = decoding.result().get("@odata.nextLink")
+
+                if previous is not None:
+                    add_page(previous.result())
+                page_num += 1
+                
+            except requests.exceptions.RequestException as e:
+                logger.error("Error fetching users page %s: %s", page_num, e)
+                if response is not None:
+                     logger.error("Response Status: %s, Body: %s", response.status_code, response.text[:500]) # Log part of the response
+                return None # Indicate failure
+            except Exception as e:
+                 logger.error("Unexpected error processing users page %s: %s", page_num, e)
+                 return None
+
+        if decoding is not None:
+            try:
+                add_page(decoding.result())
+            except Exception as e:
+                logger.error("Unexpected error processing users page %s: %s", page_num - 1, e)
+                return None
+
+    logger.info("Successfully fetched a total of %s users.", len(all_users))
+    return all_users
+
+def _retry_after_seconds(sub_response, default=1):
+    """Reads a throttled sub-response's Retry-After header, tolerating missing or malformed values."""
+    try:
+        return max(int(sub_response.get("headers", {}).get("Retry-After", default)), 0)
+    except (TypeError, ValueError):
+        return default
+
+def graph_batch(session, subrequests, max_attempts=3):
+    """
+    Sends GET sub-requests through the Graph JSON batching endpoint.
+
+    Sub-requests are packed 20 per HTTP call (the Graph limit). Sub-requests that
+    come back throttled (429/503) are retried together in a later batch.
+
+    Paged user fetches in get_all_org_users are not retried through here: each page is
+    only known from the previous page's @odata.nextLink, so there is never more than one
+    to send, and those links are absolute beta URLs while $batch takes relative v1.0 paths.
+
+    Args:
+        session (requests.Session): Authenticated Graph session from create_graph_session.
+        subrequests (list): Dicts with "id", "method" and "url" (relative to /v1.0).
+        max_attempts (int): How many times a throttled sub-request is sent before giving up.
+
+    Returns:
+        dict: Sub-request id -> response dict ("status", "headers", "body"), or None on failure.
+    """
+    results = {}
+    pending = list(subrequests)
+    attempt = 1
+
+    while pending:
+        throttled = []
+        retry_after = 1
+        for start in range(0, len(pending), GRAPH_BATCH_LIMIT):
+            chunk = pending[start:start + GRAPH_BATCH_LIMIT]
+            response = None
+            try:
+                response = session.post(GRAPH_BATCH_URL, json={"requests": chunk})
+                response.raise_for_status()
+                data = _loads(response.content)
+
+                subrequests_by_id = {subrequest["id"]: subrequest for subrequest in chunk}
+                for sub_response in data.get("responses", []):
+                    if sub_response.get("status") in (429, 503) and attempt < max_attempts:
+                        throttled.append(subrequests_by_id[sub_response["id"]])
+                        retry_after = max(retry_after, _retry_after_seconds(sub_response))
+                    else:
+                        results[sub_response["id"]] = sub_response
+            except requests.exceptions.RequestException as e:
+                logger.error("Error sending batch request: %s", e)
+                if response is not None:
+                    logger.error("Response Status: %s, Body: %s", response.status_code, response.text[:500])
+                return None
+            except Exception as e:
+                logger.error("Unexpected error processing batch response: %s", e)
+                return None
+
+        if throttled:
+            logger.warning("%s batched requests were throttled. Retrying in %ss...", len(throttled), retry_after)
+            time.sleep(retry_after)
+        pending = throttled
+        attempt += 1
+
+    return results
+
+USER_NOT_FOUND = object()  # get_user_by_email result when Graph answered but nobody matched
+
+def get_user_by_email(session, email):
+    """
+    Looks up a single enabled Member user by mail or UPN directly in Graph.
+
+    Returns:
+        dict: The user; USER_NOT_FOUND if Graph returned no match; None if the lookup failed.
+    """
+    escaped_email = email.replace("'", "''")
+    params = {
+        "$filter": f"(mail eq '{escaped_email}' or userPrincipalName eq '{escaped_email}') "
+                   "and accountEnabled eq true and userType eq 'Member'",
+        "$select": "id,displayName,userPrincipalName,mail,jobTitle,department",
+        "$expand": "manager($select=id)"
+    }
+    try:
+        response = session.get("https://graph.microsoft.com/v1.0/users", params=params)
+        response.raise_for_status()
+        users = _loads(response.content).get("value", [])
+        return users[0] if users else USER_NOT_FOUND
+    except requests.exceptions.RequestException as e:
+        logger.error("Error looking up user %s: %s", email, e)
+        return None
+    except Exception as e:
+        logger.error("Unexpected error looking up user %s: %s", email, e)
+        return None
+
+def filter_standard_users(users):
+    """Drops users without a mail or job title, plus service, admin and external accounts."""
+    # Bind the regex methods once; the whole filter runs as a single comprehension
+    excluded_upn = EXCLUDED_UPN_RE.search
+    admin_display_name = ADMIN_DISPLAY_NAME_RE.match
+    return [
+        user for user in users
+        if user.get('mail') and user.get('jobTitle')
+        and not excluded_upn(user.get("userPrincipalName") or "")
+        and not admin_display_name(user.get("displayName") or "")
+    ]
+
+class HierarchyNode:
+    """
+    A user in the org hierarchy.
+
+    Nodes use __slots__ rather than per-node dicts to keep large trees compact, and are
+    only converted to the output dict format when the JSON is written.
+    """
+    __slots__ = ('id', 'display_name', 'user_principal_name', 'mail', 'job_title', 'department',
+                 'direct_reports', 'has_manager_reports')
+
+    def __init__(self, user_data, direct_reports, has_manager_reports):
+        get = user_data.get  # Bound once; this runs for every user in the tree
+        self.id = get("id")
+        self.display_name = get("displayName")
+        self.user_principal_name = get("userPrincipalName")
+        self.mail = get("mail")
+        self.job_title = get("jobTitle")
+        self.department = get("department")
+        self.direct_reports = direct_reports
+        self.has_manager_reports = has_manager_reports
+
+    def to_dict(self):
+        """Returns the output format; direct reports are left as nodes for the encoder to convert."""
+        return {
+            "id": self.id,
+            "displayName": self.display_name,
+            "userPrincipalName": self.user_principal_name,
+            "mail": self.mail,
+            "jobTitle": self.job_title,
+            "department": self.department,
+            "directReports": self.direct_reports,
+            "hasManagerReports": self.has_manager_reports,  # Flag indicating if this manager has other managers reporting to them
+            "needsStandardList": self.has_manager_reports   # Flag indicating if this manager should have a Standard Distribution List
+        }
+
+def _encode_hierarchy_node(obj):
+    """JSON encoder hook that converts HierarchyNode objects while the output is written."""
+    if isinstance(obj, HierarchyNode):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def fetch_subtree_users(session, start_user):
+    """
+    Fetches only the start user and the users below them, one reporting level at a time.
+
+    Each level's directReports requests are packed into Graph $batch calls, so a small team
+    costs a handful of requests instead of a download of the whole tenant. Reports that fail
+    the local filters are not expanded, matching the full-tenant path where their own reports
+    are detached from the tree.
+
+    Args:
+        session (requests.Session): Authenticated Graph session from create_graph_session.
+        start_user (dict): The starting user as returned by get_user_by_email.
+
+    Returns:
+        list: Raw users in the same shape as get_all_org_users (start user first), or None on failure.
+    """
+    select_query = "id,displayName,userPrincipalName,mail,jobTitle,department,accountEnabled,userType"
+
+    # The start user's own manager is outside the fetched tree, so it is dropped
+    start_user = {key: value for key, value in start_user.items() if key != 'manager'}
+    users = [start_user]
+    if not filter_standard_users(users):
+        return users  # Filtered out locally; main reports it as not found
+
+    seen_ids = {start_user['id']}
+    managers = users
+    level_num = 1
+    while managers:
+        logger.info("Fetching direct reports of %s users at level %s...", len(managers), level_num)
+        subrequests = [
+            {
+                "id": str(i),
+                "method": "GET",
+                "url": f"/users/{manager['id']}/directReports/microsoft.graph.user?$select={select_query}&$top=999"
+            }
+            for i, manager in enumerate(managers)
+        ]
+        responses = graph_batch(session, subrequests)
+        if responses is None:
+            return None
+
+        level_reports = []
         try:
-            logger.info(f"Fetching page {page_num} of users...")
-            response = requests.get(users_url, headers=headers)
-            response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-            data = response.json()
-            
-            current_page_users = data.get("value", [])
-            all_users.extend(current_page_users)
-            logger.info(f"Fetched {len(current_page_users)} users on this page. Total fetched: {len(all_users)}")
-            
-            # Get the next page link
-            users_url = data.get("@odata.nextLink")
-            page_num += 1
-            
+            for i, manager in enumerate(managers):
+                sub_response = responses.get(str(i), {})
+                if sub_response.get("status") != 200:
+                    logger.error("Error fetching direct reports of %s: %s", manager.get('displayName'), sub_response.get("body"))
+                    return None
+                body = sub_response["body"]
+                reports = body.get("value", [])
+
+                # Managers with more than 999 reports are paged; follow those links directly
+                next_link = body.get("@odata.nextLink")
+                while next_link:
+                    response = session.get(next_link)
+                    response.raise_for_status()
+                    data = _loads(response.content)
+                    reports.extend(data.get("value", []))
+                    next_link = data.get("@odata.nextLink")
+
+                for report in reports:
+                    if report['id'] in seen_ids or not report.get('accountEnabled') or report.get('userType') != 'Member':
+                        continue
+                    seen_ids.add(report['id'])
+                    report['manager'] = {'id': manager['id']}
+                    level_reports.append(report)
         except requests.exceptions.RequestException as e:
-            logger.error(f"Error fetching users page {page_num}: {str(e)}")
-            if response:
-                 logger.error(f"Response Status: {response.status_code}, Body: {response.text[:500]}") # Log part of the response
-            return None # Indicate failure
+            logger.error("Error fetching direct reports at level %s: %s", level_num, e)
+            return None
         except Exception as e:
-             logger.error(f"Unexpected error processing users page {page_num}: {str(e)}")
-             return None
+            logger.error("Unexpected error processing direct reports at level %s: %s", level_num, e)
+            return None
 
-    logger.info(f"Successfully fetched a total of {len(all_users)} users.")
-    return all_users
+        managers = filter_standard_users(level_reports)
+        users.extend(managers)
+        level_num += 1
+
+    logger.info("Fetched %s users in the reporting tree.", len(users))
+    return users
+
+def intern_repeated_fields(users, fields=('department', 'jobTitle')):
+    """Interns values that repeat across many users so each distinct value is stored once."""
+    intern = sys.intern
+    for user in users:
+        for field in fields:
+            value = user.get(field)
+            if value:
+                user[field] = intern(value)
 
 def build_local_hierarchy(user_id, users_by_id, reports_by_manager):
-    """Recursively builds the hierarchy using pre-fetched local data."""
-    if user_id not in users_by_id:
-        logger.warning(f"User ID {user_id} found in reports_by_manager but not in main user list. Skipping.")
-        return None
-        
-    user_data = users_by_id[user_id]
-    
-    # Find direct reports for the current user
-    direct_report_ids = reports_by_manager.get(user_id, [])
-    
-    # Build direct reports first to determine if any are managers
-    direct_reports = []
-    has_manager_reports = False
-    
-    for report_id in direct_report_ids:
-        report_node = build_local_hierarchy(report_id, users_by_id, reports_by_manager)
-        if report_node:
-            direct_reports.append(report_node)
-            # Check if this direct report has their own reports
-            if report_node.get("directReports") and len(report_node["directReports"]) > 0:
-                has_manager_reports = True
-    
-    hierarchy_node = {
-        "id": user_data.get("id"),
-        "displayName": user_data.get("displayName"),
-        "userPrincipalName": user_data.get("userPrincipalName"),
-        "mail": user_data.get("mail"),
-        "jobTitle": user_data.get("jobTitle"),
-        "department": user_data.get("department"),
-        "directReports": direct_reports,
-        "hasManagerReports": has_manager_reports,  # Flag indicating if this manager has other managers reporting to them
-        "needsStandardList": has_manager_reports   # Flag indicating if this manager should have a Standard Distribution List
-    }
-            
-    return hierarchy_node
+    """
+    Builds the hierarchy using pre-fetched local data.
+
+    Walks the tree in post-order with an explicit stack instead of recursion, so deep
+    org charts cannot hit Python's recursion limit. Manager counts are accumulated
+    during the same walk.
+
+    Returns:
+        tuple: (HierarchyNode or None, total managers, managers needing a Standard List)
+    """
+    assembled = {}  # user_id -> (finished node, subtree counts), until it is attached to its manager
+    visited = set()
+    stack = [(user_id, False)]
 
-def find_user_by_email_in_list(email, users_list):
-    """Find a user by their email in the filtered users list."""
+    while stack:
+        current_id, reports_done = stack.pop()
+
+        if not reports_done:
+            if current_id not in users_by_id:
+                logger.warning("User ID %s found in reports_by_manager but not in main user list. Skipping.", current_id)
+                continue
+            if current_id in visited:
+                logger.warning("User ID %s appears more than once in the reporting chain. Skipping.", current_id)
+                continue
+            visited.add(current_id)
+
+            # Revisit this user once all direct reports are built; push the reports in
+            # reverse so they are built (and listed) in their original order
+            stack.append((current_id, True))
+            for report_id in reversed(reports_by_manager.get(current_id, [])):
+                stack.append((report_id, False))
+            continue
+
+        user_data = users_by_id[current_id]
+
+        # Direct reports are complete at this point; skipped users have no entry
+        direct_reports = []
+        total_managers = 0
+        standard_list_managers = 0
+        for report_id in reports_by_manager.get(current_id, []):
+            report = assembled.pop(report_id, None)
+            if report:
+                report_node, report_total, report_standard = report
+                direct_reports.append(report_node)
+                total_managers += report_total
+                standard_list_managers += report_standard
+
+        # Flag this user if any direct report has their own reports
+        has_manager_reports = any(report.direct_reports for report in direct_reports)
+        if direct_reports:
+            total_managers += 1
+            if has_manager_reports:
+                standard_list_managers += 1
+
+        hierarchy_node = HierarchyNode(user_data, direct_reports, has_manager_reports)
+        assembled[current_id] = (hierarchy_node, total_managers, standard_list_managers)
+
+    return assembled.get(user_id, (None, 0, 0))
+
+def build_email_index(users_list):
+    """Maps each lowercased mail and UPN to its user, keeping the first user listed for an address."""
+    email_index = {}
+    for user in users_list:
+        for address in (user.get('mail'), user.get('userPrincipalName')):
+            if address:
+                email_index.setdefault(address.lower(), user)
+    return email_index
+
+def find_user_by_email_in_list(email, email_index):
+    """Find a user by their email (mail or UPN) using an index from build_email_index."""
     if not email:
         return None
-        
-    email = email.lower()
-    for user in users_list:
-        if user.get('mail', '').lower() == email or user.get('userPrincipalName', '').lower() == email:
-            return user
-    return None
+    return email_index.get(email.lower())
 
 def main(start_email=None):
     """
@@ -207,14 +620,27 @@ def main(start_email=None):
         logger.error("Failed to get access token")
         return
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    session = create_graph_session(access_token)
+
+    # 1. Fetch the users - only the reporting tree when a start email is given, otherwise everyone
+    all_users_raw = None
+    if start_email:
+        # Resolve the starting user directly so a mistyped email does not cost a full tenant download
+        start_user = get_user_by_email(session, start_email)
+        if start_user is USER_NOT_FOUND:
+            logger.error("Could not find user with email %s in the organization. Aborting.", start_email)
+            return
+        if start_user is None:
+            logger.warning("Could not look up %s directly. Falling back to fetching all users.", start_email)
+        else:
+            logger.info("Fetching the reporting tree below %s...", start_email)
+            all_users_raw = fetch_subtree_users(session, start_user)
+            if all_users_raw is None:
+                logger.warning("Could not fetch the reporting tree directly. Falling back to fetching all users.")
 
-    # 1. Fetch all enabled Member users efficiently
-    logger.info("Starting to fetch all enabled Member users...")
-    all_users_raw = get_all_org_users(headers)
+    if all_users_raw is None:
+        logger.info("Starting to fetch all enabled Member users...")
+        all_users_raw = get_all_org_users(session)
     
     if all_users_raw is None:
         logger.error("Failed to fetch user data. Aborting.")
@@ -224,61 +650,49 @@ def main(start_email=None):
         return
         
     # --- Start Local Filtering ---
-    logger.info(f"Fetched {len(all_users_raw)} raw users. Applying local filters...")
-    all_users = []
-    excluded_patterns = [
-        "#EXT#",
-        "@avetta1.onmicrosoft.com",
-        "admin@",
-        "noreply",
-        "accounts@", 
-        "adm.", 
-        "abuse@"
-    ]
-    
-    for user in all_users_raw:
-        # Basic checks
-        if not user.get('mail') or not user.get('jobTitle'):
-            continue
-            
-        # Filter based on excluded patterns in UPN
-        upn = user.get("userPrincipalName", "").lower()
-        display_name = user.get("displayName", "").lower()
-        if any(pattern in upn for pattern in excluded_patterns) or display_name.startswith('adm'):
-            continue
-            
-        # If all checks pass, add to the final list
-        all_users.append(user)
-        
-    logger.info(f"Finished local filtering. {len(all_users)} users remaining.")
+    logger.info("Fetched %s raw users. Applying local filters...", len(all_users_raw))
+    all_users = filter_standard_users(all_users_raw)
+    del all_users_raw  # Let the rejected accounts be freed
+    intern_repeated_fields(all_users)
+    logger.info("Finished local filtering. %s users remaining.", len(all_users))
     # --- End Local Filtering ---
         
     # 2. Process the *filtered* list into dictionaries for quick lookup
     users_by_id = {user['id']: user for user in all_users}
-    reports_by_manager = defaultdict(list)
-    root_candidates = []
+    manager_ids = [(user.get('manager') or {}).get('id') for user in all_users]
 
     logger.info("Processing filtered user data to build lookup tables...")
-    for user in all_users:
-        manager_info = user.get('manager')
-        if manager_info and manager_info.get('id') in users_by_id:
-            reports_by_manager[manager_info['id']].append(user['id'])
-        elif manager_info and manager_info.get('id') not in users_by_id:
-             logger.warning(f"User {user.get('displayName')} ({user.get('id')}) has manager {manager_info.get('id')} who was filtered out. Considering this user as potential root.")
-             root_candidates.append(user)
-        else:
-             root_candidates.append(user)
+    # Count reports per manager first so each list is allocated at its final size,
+    # then fill the slots in fetched order
+    report_counts = Counter(manager_id for manager_id in manager_ids if manager_id in users_by_id)
+    reports_by_manager = {manager_id: [None] * count for manager_id, count in report_counts.items()}
+    next_slot = dict.fromkeys(report_counts, 0)
+    for user, manager_id in zip(all_users, manager_ids):
+        if manager_id in next_slot:
+            slot = next_slot[manager_id]
+            reports_by_manager[manager_id][slot] = user['id']
+            next_slot[manager_id] = slot + 1
+
+    # Users without a manager, or whose manager was filtered out, are potential roots
+    orphaned = [(user, manager_id) for user, manager_id in zip(all_users, manager_ids) if manager_id not in users_by_id]
+    root_candidates = [user for user, _ in orphaned]
+    if logger.isEnabledFor(logging.WARNING):
+        for user, manager_id in orphaned:
+            if manager_id is not None:
+                logger.warning("User %s (%s) has manager %s who was filtered out. Considering this user as potential root.", user.get('displayName'), user.get('id'), manager_id)
             
-    logger.info(f"Built lookup tables. Found {len(root_candidates)} potential root users.")
+    logger.info("Built lookup tables. Found %s potential root users.", len(root_candidates))
 
     # 3. Select the starting point - either specified email or best root user
     root_user = None
     if start_email:
-        root_user = find_user_by_email_in_list(start_email, all_users)
+        # The email index is only needed here, so users are lowercased only when a start email is given
+        email_index = build_email_index(all_users)
+        root_user = find_user_by_email_in_list(start_email, email_index)
         if not root_user:
-            logger.error(f"Could not find user with email {start_email} in the organization. Aborting.")
+            logger.error("Could not find user with email %s in the organization. Aborting.", start_email)
             return
-        logger.info(f"Starting hierarchy from specified user: {root_user.get('displayName')} (Email: {root_user.get('mail')})")
+        logger.info("Starting hierarchy from specified user: %s (Email: %s)", root_user.get('displayName'), root_user.get('mail'))
     else:
         # Use existing root selection logic
         if not root_candidates:
@@ -291,27 +705,32 @@ def main(start_email=None):
         executive_titles_svp = ['senior vice president', 'svp']
         executive_titles_vp = ['vice president', 'vp']
 
-        root_candidates.sort(key=lambda user: (
-            not any(title in user.get('jobTitle', '').lower() for title in executive_titles_highest),
-            not any(title in user.get('jobTitle', '').lower() for title in executive_titles_clevel),
-            not any(title in user.get('jobTitle', '').lower() for title in executive_titles_svp),
-            not any(title in user.get('jobTitle', '').lower() for title in executive_titles_vp),
-            user.get('displayName', '')
-        ))
+        # One case-insensitive regex per tier, so each title is scanned once per tier without lowercasing
+        title_tiers = [
+            re.compile('|'.join(map(re.escape, titles)), re.IGNORECASE)
+            for titles in (executive_titles_highest, executive_titles_clevel, executive_titles_svp, executive_titles_vp)
+        ]
+
+        def root_priority(user):
+            job_title = user.get('jobTitle') or ''
+            return tuple(not tier.search(job_title) for tier in title_tiers) + (user.get('displayName', ''),)
+
+        root_candidates.sort(key=root_priority)
 
         root_user = root_candidates[0]
         if len(root_candidates) > 1:
-             logger.warning(f"Multiple root candidates found. Sorted by title and selected: {root_user.get('displayName')}")
-             for i, candidate in enumerate(root_candidates[1:11], 1):
-                 logger.info(f"  Other root candidate {i}: {candidate.get('displayName')} ({candidate.get('jobTitle')})")
-             if len(root_candidates) > 11:
-                    logger.info(f"  ... and {len(root_candidates) - 11} more potential root candidates.")
+             logger.warning("Multiple root candidates found. Sorted by title and selected: %s", root_user.get('displayName'))
+             if logger.isEnabledFor(logging.INFO):
+                 for i, candidate in enumerate(root_candidates[1:11], 1):
+                     logger.info("  Other root candidate %s: %s (%s)", i, candidate.get('displayName'), candidate.get('jobTitle'))
+                 if len(root_candidates) > 11:
+                     logger.info("  ... and %s more potential root candidates.", len(root_candidates) - 11)
                  
-        logger.info(f"Selected root user: {root_user.get('displayName')} (ID: {root_user.get('id')}) - Job: {root_user.get('jobTitle')}")
+        logger.info("Selected root user: %s (ID: %s) - Job: %s", root_user.get('displayName'), root_user.get('id'), root_user.get('jobTitle'))
 
     # 4. Build the hierarchy locally
     logger.info("Building hierarchy from local data...")
-    org_hierarchy = build_local_hierarchy(root_user['id'], users_by_id, reports_by_manager)
+    org_hierarchy, total_managers, standard_list_managers = build_local_hierarchy(root_user['id'], users_by_id, reports_by_manager)
     
     # 5. Save the hierarchy and generate summary
     if org_hierarchy:
@@ -326,32 +745,16 @@ def main(start_email=None):
             
         output_file = output_dir / f"{filename_prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
         
-        # Count managers and distribution list requirements
-        def count_managers_in_hierarchy(node):
-            total_managers = 0
-            standard_list_managers = 0
-            if node.get("directReports"):
-                total_managers += 1
-                if node.get("needsStandardList"):
-                    standard_list_managers += 1
-            for report in node.get("directReports", []):
-                t, s = count_managers_in_hierarchy(report)
-                total_managers += t
-                standard_list_managers += s
-            return total_managers, standard_list_managers
-        
-        total_managers, standard_list_managers = count_managers_in_hierarchy(org_hierarchy)
-        logger.info(f"Organization Summary:")
-        logger.info(f"Total managers (requiring Dynamic Lists): {total_managers}")
-        logger.info(f"Managers requiring Standard Lists: {standard_list_managers}")
-        logger.info(f"Bottom-tier managers (Dynamic List only): {total_managers - standard_list_managers}")
+        logger.info("Organization Summary:")
+        logger.info("Total managers (requiring Dynamic Lists): %s", total_managers)
+        logger.info("Managers requiring Standard Lists: %s", standard_list_managers)
+        logger.info("Bottom-tier managers (Dynamic List only): %s", total_managers - standard_list_managers)
         
         try:
-            with open(output_file, 'w') as f:
-                json.dump(org_hierarchy, f, indent=2)
-            logger.info(f"Optimized organizational hierarchy saved to {output_file}")
+            output_file.write_bytes(_dumps(org_hierarchy, default=_encode_hierarchy_node))
+            logger.info("Optimized organizational hierarchy saved to %s", output_file)
         except Exception as e:
-             logger.error(f"Error saving hierarchy to file {output_file}: {str(e)}")
+             logger.error("Error saving hierarchy to file %s: %s", output_file, e)
     else:
         logger.error("Failed to build organizational hierarchy from local data.")
 